@@ -0,0 +1,111 @@
+# cython: language_level=3
+# -*- coding: utf-8 -*-
+"""
+Compiled subgraph enumeration kernel for pynets.stats.netmotifs.
+"""
+import numpy as np
+cimport cython
+from libc.stdint cimport uint8_t, int32_t
+from libcpp.vector cimport vector
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _extend(uint8_t[:, ::1] A, int32_t[::1] vsub, Py_ssize_t size,
+                  vector[int32_t] ext, int32_t[::1] nbhd, int N,
+                  vector[int32_t]& out):
+    cdef Py_ssize_t M = A.shape[0]
+    cdef Py_ssize_t k, u
+    cdef int32_t w
+    cdef int32_t root = vsub[0]
+    cdef vector[int32_t] new_ext
+
+    if size + 1 == N:
+        # Every node of the extension set completes a subgraph at the last
+        # level, so emit them in pop order without extending further
+        for u in range(<Py_ssize_t>ext.size() - 1, -1, -1):
+            for k in range(size):
+                out.push_back(vsub[k])
+            out.push_back(ext[u])
+        return
+
+    while ext.size() > 0:
+        # Remove w from the extension set, then add the neighbors of w with
+        # a larger index than root v that are not already in or adjacent to
+        # vsub
+        w = ext.back()
+        ext.pop_back()
+        new_ext = ext
+        for u in range(root + 1, M):
+            if A[u, w] and nbhd[u] == 0:
+                new_ext.push_back(<int32_t>u)
+
+        # nbhd[u] counts the nodes of vsub whose closed neighborhood holds u
+        for u in range(M):
+            if A[u, w] or u == w:
+                nbhd[u] += 1
+        vsub[size] = w
+        _extend(A, vsub, size + 1, new_ext, nbhd, N, out)
+        for u in range(M):
+            if A[u, w] or u == w:
+                nbhd[u] -= 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef enumerate_motifs(uint8_t[:, ::1] A, int N, roots=None):
+    """
+    Enumerates the node sets of all connected subgraphs of size N in A, each
+    exactly once.
+
+    Parameters
+    ----------
+    A : ndarray
+        M x M binary (uint8) connectivity matrix.
+    N : int
+        Size of motif type.
+    roots : ndarray
+        Nodes whose subgraphs are enumerated, i.e. those in which they are
+        the lowest index. Default is all nodes.
+
+    Returns
+    -------
+    X2 : ndarray
+        n_motifs x N array of node indices.
+
+    References
+    ----------
+    .. [1] Wernicke, S. (2006). Efficient Detection of Network Motifs.
+      IEEE/ACM Transactions on Computational Biology and Bioinformatics.
+      https://doi.org/10.1109/TCBB.2006.51
+
+    """
+    cdef Py_ssize_t M = A.shape[0]
+    cdef Py_ssize_t r, root, i, u
+    cdef vector[int32_t] ext
+    cdef vector[int32_t] out
+    cdef int32_t[::1] vsub = np.zeros(N, dtype=np.int32)
+    cdef int32_t[::1] nbhd = np.zeros(M, dtype=np.int32)
+    cdef int32_t[::1] out_view
+    cdef int32_t[::1] root_view = np.ascontiguousarray(
+        np.arange(M - 1) if roots is None else roots, dtype=np.int32)
+
+    for r in range(root_view.shape[0]):
+        root = root_view[r]
+        ext.clear()
+        for u in range(M):
+            if A[u, root] or u == root:
+                nbhd[u] += 1
+                if u > root:
+                    ext.push_back(<int32_t>u)
+        vsub[0] = <int32_t>root
+        _extend(A, vsub, 1, ext, nbhd, N, out)
+        for u in range(M):
+            if A[u, root] or u == root:
+                nbhd[u] -= 1
+
+    out_np = np.empty(out.size(), dtype=np.int32)
+    out_view = out_np
+    for i in range(<Py_ssize_t>out.size()):
+        out_view[i] = out[i]
+    return out_np.reshape(-1, N)
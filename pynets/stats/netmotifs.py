@@ -9,28 +9,260 @@ import numpy as np
 import warnings
 import os
 import networkx as nx
-from copy import copy
 from pathlib import Path
 from collections import Counter
 
 warnings.filterwarnings("ignore")
 
 
-def countmotifs(A, N=4):
+def pack_bits(A):
     """
-    Counts number of motifs with size N from A.
+    Packs the nonzero pattern of a connectivity matrix into rows of 64-bit
+    words, such that bit j of row i is set whenever A[i, j] is nonzero.
+
+    Parameters
+    ----------
+    A : ndarray
+        M x M Connectivity matrix
+
+    Returns
+    -------
+    A_bits : ndarray
+        M x ceil(M/64) array of np.uint64 words.
+
+    """
+    n_words = int(np.ceil(A.shape[1] / 64))
+    padded = np.zeros((A.shape[0], n_words * 64), dtype=np.uint8)
+    padded[:, :A.shape[1]] = A != 0
+    return np.packbits(padded, axis=1, bitorder="little").view("<u8")
+
+
+def enumerate_motifs(A, N, roots=None):
+    """
+    Enumerates the node sets of all connected subgraphs of size N in A, each
+    exactly once. This is the pure-Python fallback for the compiled kernel
+    of the same name in pynets.stats._motifs.
+
+    Parameters
+    ----------
+    A : ndarray
+        M x M Connectivity matrix
+    N : int
+        Size of motif type.
+    roots : ndarray
+        Nodes whose subgraphs are enumerated, i.e. those in which they are
+        the lowest index. Default is all nodes.
+
+    Returns
+    -------
+    X2 : ndarray
+        n_motifs x N array of node indices.
+
+    References
+    ----------
+    .. [1] Wernicke, S. (2006). Efficient Detection of Network Motifs.
+      IEEE/ACM Transactions on Computational Biology and Bioinformatics.
+      https://doi.org/10.1109/TCBB.2006.51
+
+    """
+    M = A.shape[0]
+
+    # Bitset representations of neighborhoods (read column-wise, i.e.
+    # A[j, v]), of single nodes, and of all node indices larger than a root
+    A_bits = pack_bits(A.T)
+    node_bits = pack_bits(np.eye(M, dtype=np.uint8))
+    high_mask = pack_bits(np.triu(np.ones((M, M), dtype=np.uint8), k=1))
+
+    # Each partial subgraph vsub carries its extension set and its closed
+    # neighborhood, so that every subgraph is grown along a single path
+    roots = np.arange(M - 1) if roots is None else np.asarray(roots)
+    X2 = roots[:, None]
+    ext2 = A_bits[roots] & high_mask[roots]
+    nbhd2 = A_bits[roots] | node_bits[roots]
+    for n in range(N - 1):
+        X, ext_all, nbhd_all = X2, ext2, nbhd2
+
+        # Each vsub has one child per node in its extension set, which sizes
+        # the next level's buffers up front
+        total = sum(bin(block).count("1")
+                    for block in ext_all.ravel().tolist())
+        if total == 0:
+            return np.empty((0, N), dtype=np.int32)
+        X2 = np.empty((total, n + 2), dtype=np.int32)
+        # Extension sets and neighborhoods are not needed past the last level
+        last = n == N - 2
+        if not last:
+            ext2 = np.empty((total, A_bits.shape[1]), dtype=A_bits.dtype)
+            nbhd2 = np.empty_like(ext2)
+
+        ptr = 0
+        for vsub, ext, nbhd in zip(X, ext_all, nbhd_all):
+            ws = []
+            for word, block in enumerate(ext.tolist()):
+                while block:
+                    low = block & -block
+                    ws.append(word * 64 + low.bit_length() - 1)
+                    block ^= low
+            if len(ws) == 0:
+                continue
+            # The child adding w drops w and its earlier siblings from the
+            # extension set, then adds the neighbors of w with a larger index
+            # than root v that are not already in or adjacent to vsub
+            end = ptr + len(ws)
+            X2[ptr:end, :-1] = vsub
+            X2[ptr:end, -1] = ws
+            if not last:
+                ext2[ptr:end] = (
+                    ext & ~np.bitwise_or.accumulate(node_bits[ws], axis=0)
+                ) | (A_bits[ws] & ~nbhd & high_mask[vsub[0]])
+                nbhd2[ptr:end] = nbhd | A_bits[ws]
+            ptr = end
+
+    return X2
+
+
+def _connected(deg, N):
+    """
+    Boolean mask of the binary size N subgraphs, given by their n_motifs x N
+    degree sequences, that are connected. For N <= 4 these are exactly the
+    subgraphs with at least N - 1 edges and no isolated node.
+    """
+    return (deg > 0).all(axis=1) & (deg.sum(axis=1) >= 2 * (N - 1))
+
+
+def _signature_counts(deg, N):
+    """
+    Counter of the sorted n_motifs x N degree sequences deg.
+    """
+    if len(deg) == 0:
+        return Counter()
+    deg = np.sort(deg, axis=1).astype(int)
+    if deg.min() >= 0 and deg.max() < N:
+        # Binary degrees are digits in base N, so each signature is encoded
+        # as a single integer whose order matches that of the sorted rows
+        place = N ** np.arange(N - 1, -1, -1)
+        counts = np.bincount(deg @ place, minlength=N ** N)
+        codes = np.flatnonzero(counts)
+        keys, counts = (codes[:, None] // place) % N, counts[codes]
+    else:
+        keys, counts = np.unique(deg, axis=0, return_counts=True)
+    return Counter(
+        {"".join(str(d) for d in key): count
+         for key, count in zip(keys.tolist(), counts.tolist())}
+    )
+
+
+def count_signatures(A, X2, N, check_connected=False):
+    """
+    Counts the degree signatures of the size N subgraphs of A induced by
+    each row of X2.
 
     Parameters
     ----------
     A : ndarray
         M x M Connectivity matrix
+    X2 : ndarray
+        n_motifs x N array of node indices.
+    N : int
+        Size of motif type.
+    check_connected : bool
+        If True, node sets whose induced subgraph is disconnected in A are
+        not counted, which requires A to be binary. Default is False.
+
+    Returns
+    -------
+    umotifs : Counter
+        Count of each motif class, keyed by its sorted degree sequence.
+
+    """
+    # Gather the induced subgraph of every motif at once and label each by
+    # its sorted degree sequence
+    deg = A[X2[:, :, None], X2[:, None, :]].sum(-1)
+    if check_connected:
+        deg = deg[_connected(deg, N)]
+    return _signature_counts(deg, N)
+
+
+def count_nested_signatures(layers, X2, N):
+    """
+    Counts the degree signatures of the connected size N subgraphs of each
+    layer of a nested stack, such as a matrix thresholded at ascending
+    thresholds.
+
+    Parameters
+    ----------
+    layers : ndarray
+        K x M x M stack of binary connectivity matrices, each a subgraph of
+        the one before.
+    X2 : ndarray
+        n_motifs x N array of node indices of the connected subgraphs of the
+        first layer.
+    N : int
+        Size of motif type.
+
+    Returns
+    -------
+    umotifs_list : list
+        K Counters of each motif class, keyed by its sorted degree sequence.
+
+    """
+    # A node set disconnected in one layer stays disconnected in every
+    # subsequent layer, so only the survivors of layer k are tested in k + 1
+    M = layers.shape[1]
+    idx = X2[:, :, None].astype(np.intp) * M + X2[:, None, :]
+    umotifs_list = []
+    for A_k in layers:
+        deg = np.take(A_k.ravel(), idx).sum(-1)
+        connected = _connected(deg, N)
+        idx = idx[connected]
+        umotifs_list.append(_signature_counts(deg[connected], N))
+    return umotifs_list
+
+
+def _enumerate_motifs(A, N, roots=None):
+    """
+    enumerate_motifs of the nonzero pattern of A, by the compiled kernel if
+    it is available and by the pure-Python fallback otherwise.
+    """
+    try:
+        from pynets.stats._motifs import enumerate_motifs
+        return enumerate_motifs(np.ascontiguousarray(A != 0, dtype=np.uint8),
+                                N, roots)
+    except ImportError:
+        from pynets.stats.netmotifs import enumerate_motifs
+        return enumerate_motifs(A, N, roots)
+
+
+def _count_rooted_signatures(layers, N, roots):
+    """
+    count_nested_signatures of the subgraphs of the first layer that are
+    rooted at roots.
+    """
+    return count_nested_signatures(layers, _enumerate_motifs(layers[0], N,
+                                                             roots), N)
+
+
+def countmotifs(A, N=4, n_jobs=1):
+    """
+    Counts number of motifs with size N from A.
+
+    Parameters
+    ----------
+    A : ndarray
+        M x M Connectivity matrix, or K x M x M stack of binary connectivity
+        matrices, each a subgraph of the one before, whose motifs are counted
+        layer by layer.
     N : int
         Size of motif type. Default is N=4, only 3 or 4 supported.
+    n_jobs : int
+        Number of processes across which the subgraphs of a K x M x M stack
+        are enumerated and counted. Default is 1.
 
     Returns
     -------
     umotifs : int
-        Total count of size N motifs for graph A.
+        Total count of size N motifs for graph A. For a K x M x M stack, a
+        list of K such counts.
 
     References
     ----------
@@ -38,47 +270,40 @@ def countmotifs(A, N=4):
       PLoS Biology. https://doi.org/10.1371/journal.pbio.0020369
 
     """
-    import gc
+    from joblib import Parallel, delayed, effective_n_jobs
+    from pynets.stats.netmotifs import count_signatures, \
+        _count_rooted_signatures, _enumerate_motifs
 
     assert N in [3, 4], "Only motifs of size N=3,4 currently supported"
-    X2 = np.array([[k] for k in range(A.shape[0] - 1)])
-    for n in range(N - 1):
-        X = copy(X2)
-        X2 = []
-        for vsub in X:
-            # in_matind list of nodes neighboring vsub with a larger index than
-            # root v
-            idx = np.where(np.any(A[(vsub[0] + 1):, vsub], 1))[0] + vsub[0] + 1
-            # Only keep node indices not in vsub
-            idx = idx[[k not in vsub for k in idx]]
-            if len(idx) > 0:
-                # If new neighbors found, add all new vsubs to list
-                X2.append([np.append(vsub, ik) for ik in idx])
-        if len(X2) > 0:
-            X2 = np.vstack(X2)
-        else:
+
+    if A.ndim == 2:
+        X2 = _enumerate_motifs(A, N)
+        if len(X2) == 0:
             umotifs = 0
             return umotifs
-
-    X2 = np.sort(X2, 1)
-    X2 = X2[
-        np.unique(
-            np.ascontiguousarray(X2).view(
-                np.dtype((np.void, X2.dtype.itemsize * X2.shape[1]))
-            ),
-            return_index=True,
-        )[1]
-    ]
-    umotifs = Counter(
-        ["".join(np.sort(np.sum(A[x, :][:, x], 1)).astype(int).astype(str))
-         for x in X2]
-    )
-    del X2
-    gc.collect()
-    return umotifs
+        return count_signatures(A, X2, N)
+
+    # Connected subgraphs of each nested layer are also connected in the
+    # first one, so their node sets only need to be enumerated once
+    assert np.all(A[1:] <= A[:-1]), \
+        "Each layer must be a subgraph of the one before"
+    roots = np.arange(A.shape[1] - 1)
+    n_chunks = min(effective_n_jobs(n_jobs), len(roots))
+    if n_chunks <= 1:
+        return _count_rooted_signatures(A, N, roots)
+
+    # Each worker enumerates and counts the subgraphs of an interleaved
+    # share of the roots, since low roots have the most subgraphs, with the
+    # layers memmapped to the loky workers
+    with Parallel(n_jobs=n_chunks, backend="loky") as parallel:
+        chunk_counts = parallel(
+            delayed(_count_rooted_signatures)(A, N, roots[k::n_chunks])
+            for k in range(n_chunks)
+        )
+    return [sum(umotifs, Counter()) for umotifs in zip(*chunk_counts)]
 
 
-def adaptivethresh(in_mat, thr, mlib, N):
+def adaptivethresh(in_mat, thr, mlib, N, n_jobs=1):
     """
     Counts number of motifs with a given absolute threshold.
 
@@ -86,16 +311,23 @@ def adaptivethresh(in_mat, thr, mlib, N):
     ----------
     in_mat : ndarray
         M x M Connectivity matrix
-    thr : float
-        Absolute threshold [0, 1].
+    thr : float or ndarray
+        Absolute threshold [0, 1], or a 1D vector of K such thresholds to
+        count in a single batch.
     mlib : list
         List of motif classes.
+    N : int
+        Size of motif type.
+    n_jobs : int
+        Number of processes across which a vector of thresholds is counted.
+        Default is 1.
 
     Returns
     -------
     mf : ndarray
         1D vector listing the total motifs of size N for each
-        class of mlib.
+        class of mlib. For a vector of thresholds, a K x len(mlib) array
+        with one such row per threshold.
 
     References
     ----------
@@ -106,7 +338,24 @@ def adaptivethresh(in_mat, thr, mlib, N):
     """
     from pynets.stats.netmotifs import countmotifs
 
-    mf = countmotifs((in_mat > thr).astype(int), N=N)
+    # Isolated vertices cannot take part in any motif, so restrict counting
+    # to the subgraph induced by vertices with at least one edge
+    if np.ndim(thr) > 0:
+        # Ascending thresholds yield nested layers, which are counted
+        # incrementally, and the counts are returned in the input order
+        order = np.argsort(thr)
+        B = (in_mat[None] > np.asarray(thr)[order, None, None]).astype(
+            np.uint8)
+        active = B[0].any(axis=1)
+        B = B[:, active][:, :, active]
+        mf = np.empty((len(order), len(mlib)), dtype=int)
+        mf[order] = [[umotifs[k] for k in mlib]
+                     for umotifs in countmotifs(B, N=N, n_jobs=n_jobs)]
+        return mf
+
+    B = (in_mat > thr).astype(np.uint8)
+    active = B.sum(axis=1) > 0
+    mf = countmotifs(B[np.ix_(active, active)], N=N)
     try:
         mf = np.array([mf[k] for k in mlib])
     except BaseException:
@@ -115,7 +364,8 @@ def adaptivethresh(in_mat, thr, mlib, N):
     return mf
 
 
-def compare_motifs(struct_mat, func_mat, name, namer_dir, bins=20, N=4):
+def compare_motifs(struct_mat, func_mat, name, namer_dir, bins=20, N=4,
+                   n_jobs=1):
     """
     Compare motif structure and population across structural and functional
     graphs to achieve a homeostatic absolute threshold of each that optimizes
@@ -123,18 +373,31 @@ def compare_motifs(struct_mat, func_mat, name, namer_dir, bins=20, N=4):
 
     Parameters
     ----------
-    in_mat : ndarray
-        M x M Connectivity matrix
-    thr : float
-        Absolute threshold [0, 1].
-    mlib : list
-        List of motif classes.
+    struct_mat : ndarray
+        M x M structural connectivity matrix.
+    func_mat : ndarray
+        M x M functional connectivity matrix.
+    name : str
+        Intended name of the multiplex object.
+    namer_dir : str
+        Path to output directory.
+    bins : int
+        Number of absolute thresholds of the functional graph to compare.
+        Default is 20.
+    N : int
+        Size of motif type. Default is 4.
+    n_jobs : int
+        Number of processes across which the motifs of all thresholds are
+        enumerated and counted. Default is 1, since this typically runs
+        within a workflow node that already has its own CPU allotment.
 
     Returns
     -------
-    mf : ndarray
-        1D vector listing the total motifs of size N for each
-        class of mlib.
+    mg_dict : dict
+        Paths to the multiplex graph of each selected threshold.
+    g_dict : dict
+        Thresholded functional and structural matrices of each selected
+        threshold.
 
     References
     ----------
@@ -144,12 +407,8 @@ def compare_motifs(struct_mat, func_mat, name, namer_dir, bins=20, N=4):
 
     """
     from pynets.stats.netmotifs import adaptivethresh
-    from pynets.core.thresholding import threshold_absolute
     from pynets.core.thresholding import standardize
-    from scipy import spatial
-    from nilearn.connectome import sym_matrix_to_vec
     import pandas as pd
-    import gc
 
     mlib = ["1113", "1122", "1223", "2222", "2233", "3333"]
 
@@ -172,30 +431,32 @@ def compare_motifs(struct_mat, func_mat, name, namer_dir, bins=20, N=4):
     tmax_func = func_mat.max()
     threshes_func = np.linspace(tmin_func, tmax_func, bins)
 
-    assert np.all(
-        struct_mat == struct_mat.T), "Structural Matrix must be symmetric"
-    assert np.all(
-        func_mat == func_mat.T), "Functional Matrix must be symmetric"
+    assert np.array_equal(
+        struct_mat, struct_mat.T), "Structural Matrix must be symmetric"
+    assert np.array_equal(
+        func_mat, func_mat.T), "Functional Matrix must be symmetric"
 
     # Count motifs
     print("%s%s%s%s" % ("Mining ", N, "-node motifs: ", mlib))
-    motif_dict = {}
-    motif_dict["struct"] = {}
-    motif_dict["func"] = {}
-
-    mat_dict = {}
-    mat_dict["struct"] = sym_matrix_to_vec(struct_mat, discard_diagonal=True)
-    mat_dict["funcs"] = {}
-    for thr_func in threshes_func:
-        # Count
-        at_func = adaptivethresh(func_mat, float(thr_func), mlib, N)
-        motif_dict["struct"]["%s%s" %
-                             ("thr-", np.round(thr_func, 4))] = at_struct
-        motif_dict["func"]["%s%s" % ("thr-", np.round(thr_func, 4))] = at_func
-        mat_dict["funcs"]["%s%s" %
-                          ("thr-", np.round(thr_func, 4))] = sym_matrix_to_vec(
-            threshold_absolute(func_mat, thr_func), discard_diagonal=True)
 
+    # Upper-triangular edge vectors of the structural graph and of the
+    # functional graph absolutely thresholded at each bin
+    triu_idx = np.triu_indices(dims_func, k=1)
+    struct_vec = struct_mat[triu_idx]
+    func_vec = func_mat[triu_idx]
+    fvecs = np.where(func_vec[None, :] >= threshes_func[:, None],
+                     func_vec[None, :], 0)
+
+    # Per-threshold state is kept as parallel arrays whose k-th rows all
+    # correspond to threshes_func[k]
+    keys = np.array(["%s%s" % ("thr-", np.round(thr_func, 4))
+                     for thr_func in threshes_func])
+    at_funcs = adaptivethresh(func_mat, threshes_func, mlib, N,
+                              n_jobs=n_jobs)
+    func_counts = at_funcs.astype(float)
+    # The structural layer is not thresholded, so its counts are shared
+    struct_counts = np.tile(at_struct.astype(float), (bins, 1))
+    for thr_func, at_func in zip(threshes_func, at_funcs):
         print(
             "%s%s%s%s%s"
             % (
@@ -206,135 +467,74 @@ def compare_motifs(struct_mat, func_mat, name, namer_dir, bins=20, N=4):
                 " total motifs",
             )
         )
-        gc.collect()
-
-    df = pd.DataFrame(motif_dict)
-
-    for idx in range(len(df)):
-        df.at[
-            df.index[idx],
-            "motif_dist"] = spatial.distance.cosine(df["struct"][idx],
-                                                      df["func"][idx])
-
-    df = df[pd.notnull(df["motif_dist"])]
-
-    for idx in range(len(df)):
-        df.at[
-            df.index[idx],
-            "graph_dist_cosine"] = spatial.distance.cosine(
-                mat_dict["struct"].reshape(-1, 1),
-                mat_dict["funcs"][df.index[idx]].reshape(-1, 1),
-            )
-        df.at[
-            df.index[idx],
-            "graph_dist_correlation"] = spatial.distance.correlation(
-                mat_dict["struct"].reshape(-1, 1),
-                mat_dict["funcs"][df.index[idx]].reshape(-1, 1),
-            )
 
-    df["struct_func_3333"] = np.zeros(len(df))
-    df["struct_func_2233"] = np.zeros(len(df))
-    df["struct_func_2222"] = np.zeros(len(df))
-    df["struct_func_1223"] = np.zeros(len(df))
-    df["struct_func_1122"] = np.zeros(len(df))
-    df["struct_func_1113"] = np.zeros(len(df))
-    df["struct_3333"] = np.zeros(len(df))
-    df["func_3333"] = np.zeros(len(df))
-    df["struct_2233"] = np.zeros(len(df))
-    df["func_2233"] = np.zeros(len(df))
-    df["struct_2222"] = np.zeros(len(df))
-    df["func_2222"] = np.zeros(len(df))
-    df["struct_1223"] = np.zeros(len(df))
-    df["func_1223"] = np.zeros(len(df))
-    df["struct_1122"] = np.zeros(len(df))
-    df["func_1122"] = np.zeros(len(df))
-    df["struct_1113"] = np.zeros(len(df))
-    df["func_1113"] = np.zeros(len(df))
-
-    for idx in range(len(df)):
-        df.at[df.index[idx], "struct_3333"] = df["struct"][idx][-1]
-        df.at[df.index[idx], "func_3333"] = df["func"][idx][-1]
-
-        df.at[df.index[idx], "struct_2233"] = df["struct"][idx][-2]
-        df.at[df.index[idx], "func_2233"] = df["func"][idx][-2]
-
-        df.at[df.index[idx], "struct_2222"] = df["struct"][idx][-3]
-        df.at[df.index[idx], "func_2222"] = df["func"][idx][-3]
-
-        df.at[df.index[idx], "struct_1223"] = df["struct"][idx][-4]
-        df.at[df.index[idx], "func_1223"] = df["func"][idx][-4]
-
-        df.at[df.index[idx], "struct_1122"] = df["struct"][idx][-5]
-        df.at[df.index[idx], "func_1122"] = df["func"][idx][-5]
-
-        df.at[df.index[idx], "struct_1113"] = df["struct"][idx][-6]
-        df.at[df.index[idx], "func_1113"] = df["func"][idx][-6]
-
-    df["struct_func_3333"] = np.abs(df["struct_3333"] - df["func_3333"])
-    df["struct_func_2233"] = np.abs(df["struct_2233"] - df["func_2233"])
-    df["struct_func_2222"] = np.abs(df["struct_2222"] - df["func_2222"])
-    df["struct_func_1223"] = np.abs(df["struct_1223"] - df["func_1223"])
-    df["struct_func_1122"] = np.abs(df["struct_1122"] - df["func_1122"])
-    df["struct_func_1113"] = np.abs(df["struct_1113"] - df["func_1113"])
-
-    df = df.drop(columns=["struct", "func"])
+    # Cosine distance between the structural and functional motif counts of
+    # every threshold at once
+    with np.errstate(divide="ignore", invalid="ignore"):
+        motif_dist = 1 - (struct_counts * func_counts).sum(1) / (
+            np.linalg.norm(struct_counts, axis=1) *
+            np.linalg.norm(func_counts, axis=1))
+
+    keep = ~np.isnan(motif_dist)
+    keys = keys[keep]
+    motif_dist = motif_dist[keep]
+    struct_counts = struct_counts[keep]
+    func_counts = func_counts[keep]
+    fvecs = fvecs[keep]
+
+    # Cosine and correlation distances between the structural edge vector
+    # and each remaining functional edge vector as matrix-vector products
+    fvecs_c = fvecs - fvecs.mean(axis=1, keepdims=True)
+    struct_vec_c = struct_vec - struct_vec.mean()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        graph_dist_cosine = 1 - (fvecs @ struct_vec) / (
+            np.linalg.norm(fvecs, axis=1) * np.linalg.norm(struct_vec))
+        graph_dist_correlation = 1 - (fvecs_c @ struct_vec_c) / (
+            np.linalg.norm(fvecs_c, axis=1) * np.linalg.norm(struct_vec_c))
+
+    # Motif columns run over mlib in reverse, with struct_* and func_*
+    # columns interleaved
+    motif_cols = [f"struct_func_{motif}" for motif in mlib[::-1]] + [
+        f"{layer}_{motif}" for motif in mlib[::-1]
+        for layer in ["struct", "func"]]
+    df = pd.DataFrame(
+        np.column_stack([
+            motif_dist,
+            graph_dist_cosine,
+            graph_dist_correlation,
+            np.abs(struct_counts - func_counts)[:, ::-1],
+            np.stack([struct_counts, func_counts], axis=2)[:, ::-1].reshape(
+                len(keys), -1),
+        ]),
+        index=keys,
+        columns=["motif_dist", "graph_dist_cosine",
+                 "graph_dist_correlation"] + motif_cols,
+    )
 
     df = df.loc[~(df == 0).all(axis=1)]
 
-    df = df.sort_values(
-        by=[
-            "motif_dist",
-            "graph_dist_cosine",
-            "graph_dist_correlation",
-            "struct_func_3333",
-            "struct_func_2233",
-            "struct_func_2222",
-            "struct_func_1223",
-            "struct_func_1122",
-            "struct_func_1113",
-            "struct_3333",
-            "func_3333",
-            "struct_2233",
-            "func_2233",
-            "struct_2222",
-            "func_2222",
-            "struct_1223",
-            "func_1223",
-            "struct_1122",
-            "func_1122",
-            "struct_1113",
-            "func_1113",
-        ],
-        ascending=[
-            True,
-            True,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-            False,
-        ],
-    )
+    # Rank by all sort keys at once, ascending only for motif_dist and
+    # graph_dist_cosine (np.lexsort takes its primary key last and, like
+    # pandas, places NaNs last)
+    sort_by = ["motif_dist", "graph_dist_cosine",
+               "graph_dist_correlation"] + motif_cols
+    ascending = {"motif_dist": True, "graph_dist_cosine": True}
+    sort_keys = np.column_stack([
+        df[col].values if ascending.get(col, False) else -df[col].values
+        for col in sort_by])
+    df = df.iloc[np.lexsort(sort_keys.T[::-1])]
 
     # Take the top 25th percentile
     df = df.head(int(0.25 * len(df)))
     best_threshes = []
     best_mats = []
     best_multigraphs = []
+
+    # The multiplex graph is built from the unthresholded layers, so it is
+    # identical for every selected threshold and only needs to be built once
+    if len(df) > 0:
+        mG = build_mx_multigraph(func_mat, struct_mat, name, namer_dir)
+
     for key in list(df.index):
         func_mat_tmp = func_mat.copy()
         struct_mat_tmp = struct_mat.copy()
@@ -345,12 +545,6 @@ def compare_motifs(struct_mat, func_mat, name, namer_dir, bins=20, N=4):
         func_mat_tmp[func_mat_tmp < func_thr] = 0
         struct_mat_tmp[struct_mat_tmp < struct_thr] = 0
         best_mats.append((func_mat_tmp, struct_mat_tmp))
-
-        mG = build_mx_multigraph(
-            func_mat,
-            struct_mat,
-            f"{name}_{key}",
-            namer_dir)
         best_multigraphs.append(mG)
 
     mg_dict = dict(zip(best_threshes, best_multigraphs))
@@ -396,6 +590,7 @@ def build_mx_multigraph(func_mat, struct_mat, name, namer_dir):
     """
     import networkx as nx
     import multinetx as mx
+    from scipy.sparse import csr_matrix, coo_matrix
 
     try:
         import cPickle as pickle
@@ -404,11 +599,13 @@ def build_mx_multigraph(func_mat, struct_mat, name, namer_dir):
 
     mg = mx.MultilayerGraph()
     N = struct_mat.shape[0]
-    adj_block = mx.lil_matrix(np.zeros((N * 2, N * 2)))
-    adj_block[0:N, N: 2 * N] = np.identity(N)
-    adj_block += adj_block.T
-    G_struct = nx.from_numpy_matrix(struct_mat)
-    G_func = nx.from_numpy_matrix(func_mat)
+    # Symmetric inter-layer coupling of each node to its own replica
+    rows = np.concatenate([np.arange(N), np.arange(N, 2 * N)])
+    cols = np.concatenate([np.arange(N, 2 * N), np.arange(N)])
+    adj_block = coo_matrix((np.ones(2 * N), (rows, cols)),
+                           shape=(2 * N, 2 * N)).tocsr()
+    G_struct = nx.from_scipy_sparse_matrix(csr_matrix(struct_mat))
+    G_func = nx.from_scipy_sparse_matrix(csr_matrix(func_mat))
     mg.add_layer(G_struct)
     mg.add_layer(G_func)
     mg.layers_interconnect(inter_adjacency_matrix=adj_block)
@@ -434,6 +631,7 @@ def motif_matching(
     multigraph_list_all,
     graph_path_list_all,
     rsn=None,
+    n_jobs=1,
 ):
     import networkx as nx
     import numpy as np
@@ -444,6 +642,7 @@ def motif_matching(
     from sklearn.metrics.pairwise import cosine_similarity
     from pynets.stats.netstats import community_resolution_selection
     from graspy.utils import remove_loops, symmetrize, get_lcc
+    from scipy.sparse import csr_matrix
 
     [struct_graph_path, func_graph_path] = paths
     struct_mat = np.load(struct_graph_path)
@@ -557,11 +756,11 @@ def motif_matching(
         func_mat = thresholding.standardize(func_mat)
 
         struct_node_comm_aff_mat = community_resolution_selection(
-            nx.from_numpy_matrix(np.abs(struct_mat))
+            nx.from_scipy_sparse_matrix(csr_matrix(np.abs(struct_mat)))
         )[1]
 
         func_node_comm_aff_mat = community_resolution_selection(
-            nx.from_numpy_matrix(np.abs(func_mat))
+            nx.from_scipy_sparse_matrix(csr_matrix(np.abs(func_mat)))
         )[1]
 
         struct_comms = []
@@ -611,26 +810,35 @@ def motif_matching(
         func_mat = np.maximum(func_mat, func_mat.T)
         try:
             [mldict, g_dict] = compare_motifs(
-                struct_mat, func_mat, name, namer_dir)
+                struct_mat, func_mat, name, namer_dir, n_jobs=n_jobs)
         except BaseException:
             print(f"Adaptive thresholding by motif comparisons failed "
                   f"for {name}. This usually happens when no motifs are found")
             return [], [], [], []
 
         multigraph_list_all.append(list(mldict.values())[0])
-        graph_path_list = []
+
+        # Archive the matrices of every selected threshold in one file
+        all_mats = {}
         for thr in list(g_dict.keys()):
-            multigraph_path_list_dict = {}
             [struct, func] = g_dict[thr]
-            struct_out = f"{namer_dir}/struct_{atlas}_{struct_name}.npy"
-            func_out = f"{namer_dir}/struct_{atlas}_{func_name}_" \
-                       f"motif-{thr}.npy"
-            np.save(struct_out, struct)
-            np.save(func_out, func)
-            multigraph_path_list_dict[f"struct_{atlas}_{thr}"] = struct_out
-            multigraph_path_list_dict[f"func_{atlas}_{thr}"] = func_out
-            graph_path_list.append(multigraph_path_list_dict)
-        graph_path_list_all.append(graph_path_list)
+            all_mats[f"struct_{thr}"] = struct
+            all_mats[f"func_{thr}"] = func
+        np.savez_compressed(f"{namer_dir}/{name[:200]}_motif-thrs.npz",
+                            **all_mats)
+
+        # Only the top-ranked threshold is consumed downstream as .npy graphs
+        thr = list(g_dict.keys())[0]
+        [struct, func] = g_dict[thr]
+        multigraph_path_list_dict = {}
+        struct_out = f"{namer_dir}/struct_{atlas}_{struct_name}.npy"
+        func_out = f"{namer_dir}/struct_{atlas}_{func_name}_" \
+                   f"motif-{thr}.npy"
+        np.save(struct_out, struct)
+        np.save(func_out, func)
+        multigraph_path_list_dict[f"struct_{atlas}_{thr}"] = struct_out
+        multigraph_path_list_dict[f"func_{atlas}_{thr}"] = func_out
+        graph_path_list_all.append([multigraph_path_list_dict])
     else:
         print(
             f"Skipping {rsn} rsn, since structural and functional graphs are "
@@ -640,7 +848,7 @@ def motif_matching(
     return name_list, metadata_list, multigraph_list_all, graph_path_list_all
 
 
-def build_multigraphs(est_path_iterlist, ID):
+def build_multigraphs(est_path_iterlist, ID, n_jobs=1):
     """
     Constructs a multimodal multigraph for each available resolution of
     vertices.
@@ -651,6 +859,9 @@ def build_multigraphs(est_path_iterlist, ID):
         List of file paths to .npy file containing graph.
     ID : str
         A subject id or other unique identifier.
+    n_jobs : int
+        Number of processes across which motifs are counted for each pair of
+        graphs. Default is 1.
 
     Returns
     -------
@@ -820,6 +1031,7 @@ def build_multigraphs(est_path_iterlist, ID):
                         multigraph_list_all,
                         graph_path_list_all,
                         rsn=rsn,
+                        n_jobs=n_jobs,
                     )
         else:
             parcel_dict[atlas] = list(set(itertools.product(
@@ -839,6 +1051,7 @@ def build_multigraphs(est_path_iterlist, ID):
                     metadata_list,
                     multigraph_list_all,
                     graph_path_list_all,
+                    n_jobs=n_jobs,
                 )
 
     graph_path_list_top = [list(i[0].values()) for i in graph_path_list_all]
@@ -3,12 +3,23 @@
 
 """The setup script."""
 
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 #from pynets.__about__ import __version__, DOWNLOAD_URL
 from pynets.__about__ import __version__
 import versioneer
 cmdclass = versioneer.get_cmdclass()
 
+# Optionally compile the motif enumeration kernel when Cython is available;
+# pynets.stats.netmotifs falls back to a pure-Python implementation otherwise
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize(
+        [Extension('pynets.stats._motifs', ['pynets/stats/_motifs.pyx'],
+                   language='c++')],
+        language_level=3)
+except ImportError:
+    ext_modules = []
+
 with open('README.rst') as readme_file:
     readme = readme_file.read()
     readme_file.close()
@@ -26,6 +37,7 @@ setup(
     author_email='dpisner@utexas.edu',
     url='https://github.com/dPys/pynets',
     packages=['pynets'],
+    ext_modules=ext_modules,
     entry_points={
         'console_scripts': [
             'pynets=pynets.cli.pynets_run:main',
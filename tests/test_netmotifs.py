@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for motif counting in pynets.stats.netmotifs
+"""
+import pytest
+import numpy as np
+from pynets.stats import netmotifs
+
+mlib = ["1113", "1122", "1223", "2222", "2233", "3333"]
+
+
+def test_countmotifs():
+    """
+    Test for countmotifs functionality on a path, a star, and a clique
+    """
+    path = np.zeros((5, 5), dtype=int)
+    path[range(4), range(1, 5)] = 1
+    path = path + path.T
+    umotifs = netmotifs.countmotifs(path, N=4)
+    assert dict(umotifs) == {"1122": 2}
+
+    star = np.zeros((5, 5), dtype=int)
+    star[0, 1:] = 1
+    star = star + star.T
+    umotifs = netmotifs.countmotifs(star, N=3)
+    assert dict(umotifs) == {"112": 6}
+
+    clique = np.ones((5, 5), dtype=int) - np.eye(5, dtype=int)
+    umotifs = netmotifs.countmotifs(clique, N=4)
+    assert dict(umotifs) == {"3333": 5}
+
+    weighted = 0.6 * path[:3, :3]
+    umotifs = netmotifs.countmotifs(weighted, N=3)
+    assert dict(umotifs) == {"001": 1}
+
+
+def test_adaptivethresh():
+    """
+    Test for adaptivethresh functionality
+    """
+    np.random.seed(42)
+    in_mat = np.random.rand(30, 30)
+    in_mat = np.triu(in_mat, 1) + np.triu(in_mat, 1).T
+
+    mf = netmotifs.adaptivethresh(in_mat, 0.8, mlib, 4)
+    assert len(mf) == len(mlib)
+    assert np.sum(mf) > 0
+
+    mf = netmotifs.adaptivethresh(in_mat, 1.0, mlib, 4)
+    assert np.sum(mf) == 0
+
+    threshes = np.linspace(0.7, 1.0, 4)
+    mfs = netmotifs.adaptivethresh(in_mat, threshes, mlib, 4)
+    assert mfs.shape == (len(threshes), len(mlib))
+    for thr, mf in zip(threshes, mfs):
+        assert np.array_equal(
+            mf, netmotifs.adaptivethresh(in_mat, thr, mlib, 4))
+
+    assert np.array_equal(
+        mfs, netmotifs.adaptivethresh(in_mat, threshes, mlib, 4, n_jobs=2))
+
+
+def test_adaptivethresh_incremental(monkeypatch):
+    """
+    Test that batched thresholds only test the node sets that were connected
+    at the previous threshold
+    """
+    np.random.seed(42)
+    in_mat = np.random.rand(30, 30)
+    in_mat = np.triu(in_mat, 1) + np.triu(in_mat, 1).T
+
+    rows = []
+    connected = netmotifs._connected
+
+    def _connected(deg, N):
+        rows.append(len(deg))
+        return connected(deg, N)
+
+    monkeypatch.setattr(netmotifs, "_connected", _connected)
+    threshes = np.linspace(0.7, 1.0, 6)
+    mfs = netmotifs.adaptivethresh(in_mat, threshes[::-1], mlib, 4)[::-1]
+
+    # The first threshold tests its own motifs, and every later one tests
+    # the motifs of the threshold before it
+    totals = mfs.sum(axis=1)
+    assert rows == [totals[0]] + list(totals[:-1])
+
+
+def test_count_signatures_disconnected():
+    """
+    Test that a layer left without connected subgraphs counts no motifs
+    """
+    X2 = np.array([[0, 1, 2, 3]])
+    umotifs = netmotifs.count_signatures(np.zeros((4, 4), dtype=np.uint8),
+                                         X2, 4, check_connected=True)
+    assert umotifs == {}
+
+
+def test_enumerate_motifs_compiled():
+    """
+    Test that the compiled enumeration kernel matches the Python fallback
+    """
+    _motifs = pytest.importorskip("pynets.stats._motifs")
+    np.random.seed(42)
+    in_mat = np.random.rand(40, 40) > 0.85
+    in_mat = np.triu(in_mat, 1) | np.triu(in_mat, 1).T
+
+    for N in [3, 4]:
+        X2 = np.sort(_motifs.enumerate_motifs(in_mat.astype(np.uint8), N))
+        X2_py = np.sort(netmotifs.enumerate_motifs(in_mat, N))
+        assert len(np.unique(X2, axis=0)) == len(X2)
+        assert np.array_equal(np.unique(X2, axis=0), np.unique(X2_py, axis=0))
+
+        roots = np.arange(0, 39, 3)
+        X2 = _motifs.enumerate_motifs(in_mat.astype(np.uint8), N, roots)
+        X2_py = netmotifs.enumerate_motifs(in_mat, N, roots)
+        assert np.all(np.isin(X2.min(axis=1), roots))
+        assert np.array_equal(np.unique(np.sort(X2), axis=0),
+                              np.unique(np.sort(X2_py), axis=0))
+
+
+def test_compare_motifs_ranking(monkeypatch, tmp_path):
+    """
+    Test that compare_motifs selects thresholds in the order of an explicit
+    sort_values ranking of per-threshold distances and motif counts
+    """
+    import pandas as pd
+    from scipy import spatial
+    from pynets.core.thresholding import standardize
+
+    np.random.seed(42)
+    struct_mat = np.random.rand(20, 20)
+    struct_mat = np.triu(struct_mat, 1) + np.triu(struct_mat, 1).T
+    func_mat = np.random.rand(20, 20)
+    func_mat = np.triu(func_mat, 1) + np.triu(func_mat, 1).T
+    bins = 20
+
+    # Motif counts proportional to the structural ones tie on motif_dist, so
+    # the remaining sort keys decide their order. The last bin counts none.
+    at_struct = np.array([1, 2, 3, 4, 5, 6])
+    at_funcs = np.array([(k % 4) * (at_struct if k % 2 else at_struct[::-1])
+                         for k in range(bins)])
+    at_funcs[-1] = 0
+    monkeypatch.setattr(
+        netmotifs, "adaptivethresh",
+        lambda in_mat, thr, *args, **kwargs:
+        at_funcs if np.ndim(thr) > 0 else at_struct)
+    monkeypatch.setattr(netmotifs, "build_mx_multigraph",
+                        lambda *args, **kwargs: "mG.pkl")
+    mg_dict, g_dict = netmotifs.compare_motifs(
+        struct_mat.copy(), func_mat.copy(), "test", str(tmp_path),
+        bins=bins, N=4, n_jobs=1)
+
+    struct_mat = standardize(struct_mat)
+    func_mat = standardize(func_mat)
+    triu_idx = np.triu_indices(20, k=1)
+    threshes = np.linspace(func_mat.min(), func_mat.max(), bins)
+    rows = {}
+    for thr, at_func in zip(threshes, at_funcs):
+        if np.sum(at_func) == 0:
+            continue
+        func_vec = np.where(func_mat >= thr, func_mat, 0)[triu_idx]
+        row = {
+            "motif_dist": spatial.distance.cosine(at_struct, at_func),
+            "graph_dist_cosine": spatial.distance.cosine(
+                struct_mat[triu_idx], func_vec),
+            "graph_dist_correlation": spatial.distance.correlation(
+                struct_mat[triu_idx], func_vec),
+        }
+        for motif, struct_count, func_count in zip(mlib, at_struct, at_func):
+            row[f"struct_func_{motif}"] = abs(struct_count - func_count)
+            row[f"struct_{motif}"] = struct_count
+            row[f"func_{motif}"] = func_count
+        rows["%s%s" % ("thr-", np.round(thr, 4))] = row
+
+    by = ["motif_dist", "graph_dist_cosine", "graph_dist_correlation"] + [
+        f"struct_func_{motif}" for motif in mlib[::-1]] + [
+        f"{layer}_{motif}" for motif in mlib[::-1]
+        for layer in ["struct", "func"]]
+    df = pd.DataFrame.from_dict(rows, orient="index")
+    df = df.sort_values(by=by, ascending=[True, True] + [False] * 19)
+    best_threshes = [str(float(key.split("-")[-1]))
+                     for key in df.head(int(0.25 * len(df))).index]
+
+    assert len(best_threshes) > 1
+    assert list(mg_dict.keys()) == best_threshes
+    assert list(g_dict.keys()) == best_threshes
+    assert set(mg_dict.values()) == {"mG.pkl"}